@@ -25,7 +25,7 @@ from concurrent.futures import ThreadPoolExecutor
 
 from ormatex_py.ode_sys import LinOp, IntegrateSys, OdeSys, OdeSplitSys, StepResult
 from ormatex_py.matexp_krylov import phi_linop, matexp_linop, kiops_fixedsteps
-from ormatex_py.matexp_phi import f_phi_k_ext, f_phi_k_sq_all, f_phi_k_pfd
+from ormatex_py.matexp_phi import f_phi_k_ext, f_phi_k_sq_all, f_phi_k_pfd, f_phi_k_pfd_banded, banded_ordering
 from ormatex_py.matexp_leja import gen_leja_fast, gen_leja_conjugate, build_a_tilde, \
         leja_shift_scale, real_leja_expmv_substep, complex_conj_leja_expmv_substep
 try:
@@ -64,10 +64,47 @@ class ExpRBIntegrator(IntegrateSys):
         self.tol_fdt = kwargs.get("tol_fdt", 1.0e-8)
         # threads
         self.executor = ThreadPoolExecutor(max_workers=2)
+        # dense Jacobian of a time invariant system and its banded ordering
+        self._cached_dense_jac = None
+        self._cached_jac_ordering = None
 
     def reset_ic(self, t0: float, y0: jax.Array):
         super().reset_ic(t0, y0)
 
+    def _dense_jac(self, sys_jac_lop: LinOp) -> jax.Array:
+        """
+        Dense Jacobian of the system. The Jacobian of a time invariant
+        system is constant and only densified on the first call.
+        """
+        if not self.sys.is_time_invariant:
+            return sys_jac_lop.dense()
+        if self._cached_dense_jac is None:
+            self._cached_dense_jac = sys_jac_lop.dense()
+        return self._cached_dense_jac
+
+    def _phi_k_pfd(self, z: jax.Array, b: jax.Array, k: int) -> jax.Array:
+        """
+        Computes phi_k(Z)b by partial fraction decomposition.
+        Uses banded solves if Z is narrow banded, else dense solves.
+        """
+        if self.sys.is_time_invariant and self._cached_jac_ordering is not None:
+            perm, lu = self._cached_jac_ordering
+        else:
+            perm, lu = banded_ordering(z)
+            if self.sys.is_time_invariant:
+                self._cached_jac_ordering = (perm, lu)
+        # banded LU only pays off if the band is small compared to the system size
+        if (lu[0] + lu[1] + 1) * 8 <= z.shape[0]:
+            return f_phi_k_pfd_banded(z, b, k, self.pfd_method, perm=perm, lu=lu)
+        return f_phi_k_pfd(z, b, k, self.pfd_method)
+
+    def _check_nonauto(self) -> bool:
+        """
+        Only compute the rhs time derivative if requested and
+        the system is not known to be time invariant.
+        """
+        return self.tol_fdt >= 0 and not self.sys.is_time_invariant
+
     def _phi2v_nonauto(self, sys_jac_lop, dt, c=1.0):
         r"""
         For rosenbrock exp integrators, this method computes
@@ -81,7 +118,7 @@ class ExpRBIntegrator(IntegrateSys):
             SIAM Journal on Numerical Analysis 47.1 (2009): 786-803.
         """
         # only compute rhs time derivative if requested
-        if self.tol_fdt >= 0:
+        if self._check_nonauto():
             # deriv of rhs wrt time at current time
             fytt = sys_jac_lop._fdt()
             # check for nonautonomous system
@@ -317,18 +354,18 @@ class ExpRBIntegrator(IntegrateSys):
         sys_jac_lop = self.sys.fjac(t, yt, frhs_kwargs=frhs_kwargs)
         fyt = sys_jac_lop._frhs_cached()
 
-        J = sys_jac_lop.dense()
+        J = self._dense_jac(sys_jac_lop)
 
         # check for nonautonomous system
         phi2J_fytt = 0.
-        if self.tol_fdt >= 0.:
+        if self._check_nonauto():
             # deriv of rhs wrt time at current time
             fytt = sys_jac_lop._fdt()
             if jnp.linalg.norm(fytt, ord=jax.numpy.inf) > self.tol_fdt:
-                phi2J_fytt = f_phi_k_pfd(J*dt, fytt, 2, self.pfd_method)
+                phi2J_fytt = self._phi_k_pfd(J*dt, fytt, 2)
 
         # TODO eliminate redundant rational solves for nonautonomous system
-        phi1J_fyt = f_phi_k_pfd(J*dt, fyt, 1, self.pfd_method)
+        phi1J_fyt = self._phi_k_pfd(J*dt, fyt, 1)
 
         y_new = yt + dt * (phi1J_fyt + dt * phi2J_fytt)
 
@@ -347,11 +384,11 @@ class ExpRBIntegrator(IntegrateSys):
         sys_jac_lop = self.sys.fjac(t, yt)
         fyt = sys_jac_lop._frhs_cached()
 
-        J = np.asarray(sys_jac_lop.dense())
+        J = np.asarray(self._dense_jac(sys_jac_lop))
 
         # check for nonautonomous system
         phi2J_fytt = 0.
-        if self.tol_fdt >= 0.:
+        if self._check_nonauto():
             # deriv of rhs wrt time at current time
             fytt = sys_jac_lop._fdt()
             if jnp.linalg.norm(fytt, ord=jax.numpy.inf) > self.tol_fdt:
@@ -376,7 +413,7 @@ class ExpRBIntegrator(IntegrateSys):
         """
         t = self.t
         yt = self.y_hist[0]
-        J = np.asarray(self.sys.fjac(t, yt).dense())
+        J = np.asarray(self._dense_jac(self.sys.fjac(t, yt)))
         phi0J_yt = self.phikv_dense_rs.eval(J, dt, np.asarray(yt).reshape(-1,1), 0)
         y_new = jnp.asarray(phi0J_yt.flatten())
         y_err = -1.
@@ -392,9 +429,9 @@ class ExpRBIntegrator(IntegrateSys):
         """
         t = self.t
         yt = self.y_hist[0]
-        J = np.asarray(self.sys.fjac(t, yt, frhs_kwargs=frhs_kwargs).dense())
+        J = np.asarray(self._dense_jac(self.sys.fjac(t, yt, frhs_kwargs=frhs_kwargs)))
 
-        phi0J_yt = f_phi_k_pfd(J*dt, yt, 0, self.pfd_method)
+        phi0J_yt = self._phi_k_pfd(J*dt, yt, 0)
         y_new = jnp.asarray(phi0J_yt.flatten())
         y_err = -1.
         return StepResult(t+dt, dt, y_new, y_err)
@@ -407,6 +407,15 @@ class OdeSys(eqx.Module):
         """
         return self._fm(t, u, **kwargs)
 
+    @property
+    def is_time_invariant(self) -> bool:
+        """
+        True if the system is autonomous with a constant Jacobian,
+        i.e. F(t, U) = J U + c with constant J and c.
+        Integrators may then reuse the Jacobian across steps.
+        """
+        return False
+
     @abstractmethod
     def _frhs(self, t: float, u: jax.Array, **kwargs) -> jax.Array:
         # the user must override this
@@ -11,6 +11,8 @@ from jax.experimental import sparse as jsp
 from collections.abc import Callable
 
 import skfem as fem
+from skfem.element import DiscreteField
+from skfem.assembly.form.form import FormExtraParams
 from skfem.helpers import dot, grad, div, dd
 
 from ormatex_py.progression import element_line_pp_nodal as el_nodal
@@ -40,9 +42,10 @@ def vel_f(x, vel, **kwargs):
         x: Array of shape [1,N1,N2,...] (the first dim is the spatial dim=1)
         vel: velocity coefficient
 
-    returns: Array of shape x.shape
+    returns: scalar or Array of shape [N1,N2,...] (the x-component of the velocity)
     """
-    return 0.0 * x + vel
+    # a uniform velocity is returned as a scalar and broadcast in the kernels
+    return vel
 
 def tau_upwind_f(w):
     """
@@ -62,7 +65,7 @@ def adv_diff(u, v, w):
         w: is a dict of skfem.element.DiscreteField
             w.x (quadrature points)
     """
-    return w['nu'] * dot(grad(u), grad(v)) + dot(vel_f(**w), grad(u)) * v
+    return w['nu'] * dot(grad(u), grad(v)) + vel_f(**w) * grad(u)[0] * v
 
 @fem.BilinearForm
 def adv_diff_cons(u, v, w):
@@ -75,21 +78,25 @@ def adv_diff_cons(u, v, w):
         w: is a dict of skfem.element.DiscreteField
             w.x (quadrature points)
     """
-    return w['nu'] * dot(grad(u), grad(v)) - dot(vel_f(**w) * u, grad(v))
+    return w['nu'] * dot(grad(u), grad(v)) - vel_f(**w) * u * grad(v)[0]
 
 @fem.BilinearForm
 def adv_diff_cons_supg(u, v, w):
     """
     Combo Adv Diff kernel conservative form with SUPG stab.
 
+    Reference for adv_diff_cons_supg_local, which is used in the assembly.
+    Changes to this kernel must be made to both, see tests/test_adv_diff_sem.py.
+
     Args:
         w: is a dict of skfem.element.DiscreteField
             w.x (quadrature points)
     """
-    r = w['nu'] * dot(grad(u), grad(v)) - dot(vel_f(**w) * u, grad(v))
+    vel = vel_f(**w)
+    r = w['nu'] * dot(grad(u), grad(v)) - vel * u * grad(v)[0]
     # advection supg term (adds artificial diffusion)
     tau = tau_upwind_f(w)
-    stab_adv = dot(tau * vel_f(**w), grad(v)) * dot(vel_f(**w), grad(u))
+    stab_adv = tau * vel * grad(v)[0] * vel * grad(u)[0]
     # diffusion supg term
     # NOTE: second deriv of u is not defined everywhere for linear basis fns. so this fails.
     # stab_diff = dot(w['tau'] * vel_f(**w), grad(v)) * w['nu'] * div(grad(u))
@@ -102,7 +109,7 @@ def robin(u, v, w):
         w: is a dict of skfem.element.DiscreteField (or user types)
             w.n (face normals)
     """
-    return dot(vel_f(**w), w.n) * u * v
+    return vel_f(**w) * w.n[0] * u * v
 
 @fem.LinearForm
 def rhs(v, w):
@@ -118,7 +125,7 @@ def rhs_supg(v, w):
     """
     r = src_f(**w) * v
     tau = tau_upwind_f(w)
-    stab_f =  dot(tau * vel_f(**w), grad(v)) * src_f(**w)
+    stab_f =  tau * vel_f(**w) * grad(v)[0] * src_f(**w)
     return r - stab_f
 
 @fem.BilinearForm
@@ -129,9 +136,44 @@ def mass(u, v, _):
 def mass_supg(u, v, w):
     r =  u * v
     tau = tau_upwind_f(w)
-    stab_m = dot(tau * vel_f(**w), grad(v)) * u
+    stab_m = tau * vel_f(**w) * grad(v)[0] * u
     return r + stab_m
 
+@fem.LinearForm
+def mass_lumped_supg(v, w):
+    """
+    Row sums of the mass matrix with SUPG stab.
+    """
+    tau = tau_upwind_f(w)
+    return v + tau * vel_f(**w) * grad(v)[0]
+
+def adv_diff_cons_supg_local(dx, phi, dphi, w):
+    """
+    Batched local matrices of the adv_diff_cons_supg kernel,
+    which is kept as the reference implementation.
+
+    Evaluates the kernel for all elements in one contraction over the
+    quadrature points, instead of one kernel call per pair of local
+    basis functions as in the generic skfem assembly.
+
+    Args:
+        dx: quadrature weights times Jacobian, shape [Nelems,Nq]
+        phi: basis function values, shape [Nbfun,Nelems,Nq]
+        dphi: basis function gradients, shape [Nbfun,1,Nelems,Nq]
+        w: skfem.assembly.form.form.FormExtraParams
+
+    returns: Array of shape [Nelems,Nbfun,Nbfun], entry [e,i,j] couples
+        test function i and trial function j on element e
+    """
+    vel = vel_f(**w)
+    tau = tau_upwind_f(w)
+    # coefficients of the (grad u, grad v) and (u, grad v) terms
+    c_gg = np.broadcast_to((w['nu'] + tau * vel * vel) * dx, dx.shape)
+    c_g0 = np.broadcast_to(-vel * dx, dx.shape)
+    dphi_x = dphi[:, 0]
+    return np.einsum('eq,ieq,jeq->eij', c_gg, dphi_x, dphi_x) \
+         + np.einsum('eq,ieq,jeq->eij', c_g0, dphi_x, phi)
+
 
 class AdDiffSEM:
     """
@@ -151,6 +193,12 @@ class AdDiffSEM:
         self.p = p
         self.mesh = mesh
 
+        # cache of assembled (A, Ml, b), keyed by the assembly args
+        self._asm_cache = {}
+        # cache of the own bases tabulated at the quadrature points,
+        # keyed by the basis attribute name
+        self._tab_cache = {}
+
         # register custom field functions
         self.field_fns = {}
         for k, v in field_fns.items():
@@ -176,50 +224,128 @@ class AdDiffSEM:
     def validate_add_field_fn(self, field_name: str, f: Callable):
         assert callable(f)
         self.field_fns[field_name] = f
+        # field functions enter the assembled forms, invalidate the cache
+        self._asm_cache.clear()
+
+    def _tabulate(self, basis):
+        """
+        Basis function values and gradients at the quadrature points,
+        of shape [Nbfun,Nelems,Nq] and [Nbfun,1,Nelems,Nq]
+
+        Only self.basis and self.basis_f are cached, other bases are tabulated on each call.
+        """
+        key = next((k for k in ("basis", "basis_f") if getattr(self, k, None) is basis), None)
+        # the cache entry holds the basis, check it is still the same object
+        if key in self._tab_cache and self._tab_cache[key][0] is basis:
+            return self._tab_cache[key][1:]
+
+        phi = np.stack([np.asarray(basis.basis[i][0]) for i in range(basis.Nbfun)])
+        dphi = np.stack([basis.basis[i][0].grad for i in range(basis.Nbfun)])
+        if key is not None:
+            self._tab_cache[key] = (basis, phi, dphi)
+        return phi, dphi
 
     def w_ext(self, basis, **kwargs):
         """
         Extra kwargs passed with the `w` dict to kernels
         """
         fields = {}
-        for field_name, field_f in self.field_fns.items():
-            # nodal field values
-            fx = field_f(x=basis.doflocs, **self.params, **kwargs)
-
-            # turn vector fields into scalar fields for interpolate (flatten in 1D)
+        if self.field_fns:
+            # nodal field values, stacked to shape [F,N]
+            # turn vector fields into scalar fields for interpolation (flatten in 1D)
             # basis is the basis for a scalar field and can not handle vector fields
-            fv = basis.interpolate(fx.flatten())
-
-            fields[field_name] = fv
+            fx = np.stack([
+                field_f(x=basis.doflocs, **self.params, **kwargs).flatten()
+                for field_f in self.field_fns.values()])
+
+            # interpolate all fields at once with the tabulated basis
+            phi, dphi = self._tabulate(basis)
+            fe = fx[:, basis.element_dofs]
+            fv = np.einsum('fie,ieq->feq', fe, phi)
+            fg = np.einsum('fie,ideq->fdeq', fe, dphi)
+
+            for i, field_name in enumerate(self.field_fns):
+                fields[field_name] = DiscreteField(fv[i], fg[i])
         return {**self.params, **fields}
 
-    def assemble(self, **kwargs):
+    def _asm_key(self, **kwargs):
         """
-        kwargs: extra args passed to user defined field functions
+        Hashable key for the assembly cache, or None if kwargs are unhashable
         """
+        key = (tuple(sorted(kwargs.items())), tuple(sorted(self.params.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _assemble_forms(self, **kwargs):
+        """
+        Assemble the raw (A, Ml, b) without boundary conditions applied
+        """
+        # remark: w_dict must contain only scalars and skfem.element.DiscreteField
+        # evaluate the fields once and share them between all forms on a basis
+        w = self.w_ext(self.basis, **kwargs)
+
         conservative = True
         if conservative:
-            # remark: w_dict must contain only scalars and skfem.element.DiscreteField
-            A = adv_diff_cons_supg.assemble(self.basis, **self.w_ext(self.basis, **kwargs))
+            A = self._assemble_adv_diff_cons_supg(w)
             if self.mesh.boundaries:
                 # if not periodic, add boundary term
                 A += robin.assemble(self.basis_f, **self.w_ext(self.basis_f, **kwargs))
         else:
-            A = adv_diff.assemble(self.basis, **self.w_ext(self.basis, **kwargs))
+            A = adv_diff.assemble(self.basis, **w)
+
+        b = rhs_supg.assemble(self.basis, **w)
+        # the consistent mass matrix M (mass_supg) is never built,
+        # only its row sums, which form the lumped mass Ml
+        Ml = mass_lumped_supg.assemble(self.basis, **w)
+        return A, Ml, b
+
+    def _assemble_adv_diff_cons_supg(self, w):
+        """
+        Assemble adv_diff_cons_supg on self.basis from batched local matrices
+        """
+        basis = self.basis
+        phi, dphi = self._tabulate(basis)
+        wp = FormExtraParams({**basis.default_parameters(), **w})
+        Ke = adv_diff_cons_supg_local(basis.dx, phi, dphi, wp)
+
+        # scatter in the element major layout of Ke, no reordering of the data
+        dofmap = basis.element_dofs.T
+        rows = np.broadcast_to(dofmap[:,:,None], Ke.shape)
+        cols = np.broadcast_to(dofmap[:,None,:], Ke.shape)
+        A = sp.sparse.coo_matrix(
+                (Ke.ravel(), (rows.ravel(), cols.ravel())), shape=(basis.N, basis.N))
+        A.eliminate_zeros()
+        return A.tocsr()
+
+    def assemble(self, **kwargs):
+        """
+        kwargs: extra args passed to user defined field functions
 
-        b = rhs_supg.assemble(self.basis, **self.w_ext(self.basis, **kwargs))
-        M = mass_supg.assemble(self.basis, **self.w_ext(self.basis, **kwargs))
+        The raw forms are cached and reused on repeated calls with
+        the same kwargs and params.
+        """
+        key = self._asm_key(**kwargs)
+        if key is not None and key in self._asm_cache:
+            A, Ml, b = self._asm_cache[key]
+        else:
+            A, Ml, b = self._assemble_forms(**kwargs)
+            if key is not None:
+                self._asm_cache[key] = (A, Ml, b)
 
+        # enforce on copies, such that the cached forms stay reusable
         if self.mesh.boundaries:
             # Dirichlet boundary conditions
-            fem.enforce(A, b, D=self.dirichlet_bd, overwrite=True)
-            fem.enforce(M, D=self.dirichlet_bd, overwrite=True)
+            D = self.dirichlet_bd
         else:
             # periodic boundary conditions
-            fem.enforce(A, b, D=self.basis.get_dofs().flatten(), overwrite=True)
-            fem.enforce(M, D=self.basis.get_dofs().flatten(), overwrite=True)
-
-        Ml = M @ np.ones((M.shape[1],))
+            D = self.basis.get_dofs().flatten()
+        A, b = fem.enforce(A, b, D=D)
+        # enforce only modifies the rows in D, where the mass is replaced by one
+        Ml = Ml.copy()
+        Ml[D] = 1.
 
         # provide jax arrays
         jMl = jnp.asarray(Ml)
@@ -235,6 +361,65 @@ class AdDiffSEM:
         return AffineLinearSEM(self, **kwargs)
 
 
+def matvec_format(A: jsp.JAXSparse, max_dense_n: int=256,
+                  max_density_n: int=4096, min_density: float=0.075):
+    """
+    Pick the representation of A for repeated matvecs.
+
+    For small or fairly dense systems a dense matvec beats the sparse matvec,
+    which is dominated by gather/scatter overhead on CPU.
+
+    Args:
+        A: sparse matrix
+        max_dense_n: largest system size to always store as a dense array
+        max_density_n: largest system size to store as a dense array
+            if the fill fraction of A exceeds min_density
+        min_density: fill fraction above which a dense matvec is faster
+    """
+    n = A.shape[0]
+    density = A.nse / (n * A.shape[1])
+    if n <= max_dense_n or (n < max_density_n and density > min_density):
+        return A.todense()
+    return A
+
+
+@jax.jit
+def affine_frhs(L, b_over_Ml, bd_mask, u):
+    """
+    RHS of the affine linear system, M_l^-1 (b - A u), as a pure function
+    of the constant system arrays, so that the ODE system is not traced per call.
+
+    L: the scaled operator -M_l^-1 A
+    bd_mask: zero on the Dirichlet boundary dofs and one elsewhere
+    """
+    # set the time derivative of the Dirichlet boundary data to zero
+    return (b_over_Ml + L @ u) * bd_mask
+
+@jax.jit
+def nonautonomous_frhs(L, b_over_Ml, bd_mask, t, u):
+    """
+    RHS of the affine linear system with nonautonomous Dirichlet data
+    """
+    f = (b_over_Ml + L @ u) * bd_mask
+    # set the time derivative of the Dirichlet boundary data
+    return f + (1. - bd_mask) * dirichlet_dt(t)
+
+@jax.jit
+def dirichlet_dt(t: float):
+    """
+    Time derivative of the Dirichlet data corresponding to default analytic solution
+    """
+    wc, ww = 0.3, 0.05
+    vel = 0.5
+    # Dirichlet data g(t) = exp(-(d(t)/(2 ww))^2), with d(t) the torus distance
+    # of 0 and s = (wc + t vel) % 1, i.e. d = s for s <= 0.5 and d = 1 - s otherwise
+    s = (wc + t*vel) % 1
+    d = torus_distance(s, 0.)
+    d_dt = jnp.where(s > 0.5, -vel, vel)
+    # closed form of dg/dt
+    return -2. * d * d_dt / (2*ww)**2 * jnp.exp(-(d/(2*ww))**2.0)
+
+
 class AffineLinearSEM(OdeSplitSys):
     """
     Define ODE System associated to affine linear sparse Jacobian problem
@@ -243,37 +428,49 @@ class AffineLinearSEM(OdeSplitSys):
     Implement a linear operator L equal to Jacobian to test non-Rosenbrock schemes.
     All schemes should be exact (up to Krylov error) since the residual term vanishes.
     """
-    A: jsp.JAXSparse
     Ml: jax.Array
+    inv_Ml: jax.Array
     b: jax.Array
+    b_over_Ml: jax.Array
+    _L: MatrixLinOp
 
     dirichlet_bd: np.array
+    _bd_mask: jax.Array
 
     def __init__(self, sys_assembler: AdDiffSEM, *args, **kwargs):
-        self.A, self.Ml, self.b = sys_assembler.assemble(**kwargs)
+        A, self.Ml, self.b = sys_assembler.assemble(**kwargs)
+
+        # the lumped mass is constant, scale the rows of A and b once
+        self.inv_Ml = 1. / self.Ml
+        self.b_over_Ml = self.b * self.inv_Ml
+        # the split linear operator L = -M_l^-1 A is constant, construct it once.
+        # it is the only copy of the operator, the rhs is evaluated with it as well
+        self._L = MatrixLinOp(matvec_format(-(A * self.inv_Ml[:,None])))
 
         # Dirichlet boundary conditions
         if sys_assembler.dirichlet_bd is not None:
             self.dirichlet_bd = sys_assembler.dirichlet_bd
         else:
             self.dirichlet_bd = np.array([], dtype=int)
+        bd_mask = np.ones(self.Ml.shape[0])
+        bd_mask[self.dirichlet_bd] = 0.
+        self._bd_mask = jnp.asarray(bd_mask)
 
         super().__init__()
 
-    @jax.jit
     def _frhs(self, t: float, u: jax.Array, **kwargs) -> jax.Array:
-        f = (self.b - self.A @ u) / self.Ml
-        # set the time derivative of the Dirichlet boundary data to zero
-        f = f.at[self.dirichlet_bd].set(0.)
-        return f
+        return affine_frhs(self._L.a, self.b_over_Ml, self._bd_mask, u)
 
-    @jax.jit
     def _fl(self, t: float, u: jax.Array, **kwargs):
-        return MatrixLinOp(-self.A / self.Ml[:,None])
+        return self._L
 
     def _fm(self, t: float, u: jax.Array, **kwargs):
         return DiagLinOp(self.Ml)
 
+    @property
+    def is_time_invariant(self) -> bool:
+        return True
+
 
 class NonautonomousSEM(AffineLinearSEM):
     """
@@ -282,27 +479,20 @@ class NonautonomousSEM(AffineLinearSEM):
     The same as AffinLinearSEM, but with nonautonomous Dirichlet boundary conditions
     """
 
-    @jax.jit
+    @property
+    def is_time_invariant(self) -> bool:
+        # the Dirichlet data depends on t
+        return False
+
     def dirichlet_dt(self, t: float):
-        # use the dirichlet data corresponding to default analytic solution
-        wc, ww = 0.3, 0.05
-        vel = 0.5
-        dirichlet_fun = \
-            lambda time: jnp.exp(-(torus_distance(0., (wc+time*vel))/(2*ww))**2.0)
-        # return the time derivative of the Dirichlet data
-        return jax.grad(dirichlet_fun)(t)
+        return dirichlet_dt(t)
 
-    @jax.jit
     def _frhs(self, t: float, u: jax.Array, **kwargs) -> jax.Array:
-        f = (self.b - self.A @ u) / self.Ml
-        # set the time derivative of the Dirichlet boundary data
-        f = f.at[self.dirichlet_bd].set(self.dirichlet_dt(t))
-        return f
+        return nonautonomous_frhs(self._L.a, self.b_over_Ml, self._bd_mask, t, u)
 
 def torus_distance(x, xp):
     """ distance of two points on torus (up to equivalence) """
-    dx = jnp.abs(x%1 - xp%1)
-    return jnp.where(dx > 0.5, 1. - dx, dx)
+    return 0.5 - jnp.abs(((x - xp) % 1) - 0.5)
 
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
@@ -413,25 +603,22 @@ if __name__ == "__main__":
             leja_c=args.leja_c, dd_method=args.dd_method)
     t_res, y_res = res.t_res, res.y_res
 
-    # compute expected solution
-    y_exact_res = []
-    for t in t_res:
-        y_exact_res.append(g_prof_exact(t, xs))
-
     # plot the result at a few time steps
     # sorted x
     si = xs.argsort()
     sx = xs[si]
+
+    # store results and expected solution as [nsteps+1, Ndof] arrays, sorted in x
+    t_res = np.asarray(t_res)
+    y_mat = np.asarray(jnp.stack(y_res))[:, si]
+    y_exact_mat = np.asarray(g_prof_exact(t_res[:, None], xs[None, :]))[:, si]
+
     mesh_spacing = (sx[1] - sx[0])
     cfl = dt * vel / mesh_spacing
     plt.figure()
-    for i in range(nsteps+1):
-        if i == nsteps or i == 0:
-            t = t_res[i]
-            y = y_res[i][si]
-            y_exact = y_exact_res[i][si]
-            plt.plot(sx, y, label='t=%0.4f' % t)
-            plt.plot(sx, y_exact, ls='--', label='exact t=%0.4f' % t)
+    for i in (0, nsteps):
+        plt.plot(sx, y_mat[i], label='t=%0.4f' % t_res[i])
+        plt.plot(sx, y_exact_mat[i], ls='--', label='exact t=%0.4f' % t_res[i])
     plt.legend()
     plt.grid(ls='--')
     plt.ylabel('u')
@@ -443,7 +630,7 @@ if __name__ == "__main__":
     # Print results summary to table
     print("CFL: %0.4f, Ndof: %d" % (cfl, xs.size))
 
-    err = y_exact - y
+    err = y_exact_mat[-1] - y_mat[-1]
     l2 = np.sqrt(np.sum(err**2 * ode_sys.Ml))
     l1 = np.linalg.norm(err * ode_sys.Ml, 1)
     linf = np.linalg.norm(err, np.inf)
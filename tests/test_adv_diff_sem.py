@@ -0,0 +1,172 @@
+"""
+Test the assembly of the 1D advection diffusion SEM operators
+"""
+import pytest
+import numpy as np
+# scikit-fem is an optional dependency
+fem = pytest.importorskip("skfem")
+import jax
+import jax.numpy as jnp
+jax.config.update("jax_enable_x64", True)
+
+from ormatex_py.progression.advection_diffusion_1d import AdDiffSEM, AffineLinearSEM, NonautonomousSEM, \
+        adv_diff_cons_supg
+from ormatex_py import ode_exp
+from ormatex_py.ode_exp import ExpRBIntegrator
+from ormatex_py.matexp_phi import f_phi_k_pfd, dense_bandwidth
+
+
+def line_mesh(nrefs: int):
+    return fem.MeshLine1().refined(nrefs).with_boundaries({
+        'left': lambda x: np.isclose(x[0], 0.),
+        'right': lambda x: np.isclose(x[0], 1.)
+    })
+
+
+def gauss_ic(sem: AdDiffSEM) -> jax.Array:
+    xs = sem.basis.doflocs[0]
+    return jnp.asarray(np.exp(-((xs - 0.3) / 0.1)**2))
+
+
+def exprb2_pfd_ref(sys, t, y, dt, pfd_method):
+    """
+    One exprb2 step with dense PFD solves
+    y + dt phi_1(dt J) F(t, y) + dt^2 phi_2(dt J) F_t(t, y)
+    """
+    sys_jac_lop = sys.fjac(t, y)
+    J = sys_jac_lop.dense()
+    fy = sys_jac_lop._frhs_cached()
+    fyt = sys_jac_lop._fdt()
+    return y + dt * f_phi_k_pfd(dt*J, fy, 1, pfd_method) \
+             + dt**2 * f_phi_k_pfd(dt*J, fyt, 2, pfd_method)
+
+
+def vel_field(x, vel, **kwargs):
+    """
+    Spatially varying velocity field, bounded away from zero
+    """
+    return vel * (1. + 0.4 * np.sin(2. * np.pi * x[0]))
+
+
+def test_adv_diff_cons_supg_local():
+    """
+    Check the batched local assembly against the skfem reference form
+    """
+    mesh = line_mesh(4)
+    for p in range(1, 5):
+        for tau in [0., 0.7]:
+            for field_fns in [{}, {"vel": vel_field}]:
+                params = {"nu": 1e-3, "vel": 0.5, "tau": tau}
+                sem = AdDiffSEM(mesh, p=p, field_fns=field_fns, params=params)
+                w = sem.w_ext(sem.basis)
+                A = sem._assemble_adv_diff_cons_supg(w).toarray()
+                A_ref = adv_diff_cons_supg.assemble(sem.basis, **w).toarray()
+                assert np.allclose(A, A_ref, rtol=1e-12, atol=1e-12 * np.abs(A_ref).max())
+
+
+def test_w_ext_interpolate():
+    """
+    Check the field interpolation of w_ext against skfem on own and temporary bases
+    """
+    mesh = line_mesh(3)
+    field_f = lambda x, **kwargs: np.sin(3. * x[0])
+    sem = AdDiffSEM(mesh, p=2, field_fns={"g": field_f})
+    bases = [sem.basis, sem.basis_f] \
+          + [fem.Basis(mesh, el) for el in [fem.ElementLineP1(), fem.ElementLineP2()] * 4]
+    for basis in bases:
+        g = sem.w_ext(basis)["g"]
+        g_ref = basis.interpolate(field_f(basis.doflocs))
+        assert np.allclose(np.asarray(g), np.asarray(g_ref))
+        assert np.allclose(g.grad, g_ref.grad)
+    # only the own bases are cached
+    assert set(sem._tab_cache) == {"basis", "basis_f"}
+
+
+def test_time_invariant_jac_cache():
+    """
+    Check that the dense Jacobian is only cached for time invariant systems
+    """
+    dt = 0.1
+    pfd_method = "cram_16"
+    sem = AdDiffSEM(line_mesh(2), p=2, params={"nu": 1e-3, "vel": 0.5})
+    y0 = gauss_ic(sem)
+
+    # affine linear system: the Jacobian is densified once and reused
+    ode_sys = AffineLinearSEM(sem)
+    assert ode_sys.is_time_invariant
+    sys_int = ExpRBIntegrator(ode_sys, 0., y0, method="exprb2_pfd", pfd_method=pfd_method)
+    assert not sys_int._check_nonauto()
+    assert sys_int._cached_dense_jac is None
+    sys_int.accept_step(sys_int.step(dt))
+    J = sys_int._cached_dense_jac
+    assert J is not None
+    sys_int.accept_step(sys_int.step(dt))
+    assert sys_int._cached_dense_jac is J
+    assert jnp.allclose(J, ode_sys.fjac(sys_int.t, sys_int.y_hist[0]).dense())
+
+    # nonautonomous system: no caching, the time derivative of the rhs is used
+    # start when the Dirichlet data changes fast
+    t0 = 1.54
+    ode_sys = NonautonomousSEM(sem)
+    assert not ode_sys.is_time_invariant
+    sys_int = ExpRBIntegrator(ode_sys, t0, y0, method="exprb2_pfd", pfd_method=pfd_method)
+    assert sys_int._check_nonauto()
+    s = sys_int.step(dt)
+    assert sys_int._cached_dense_jac is None
+    # the dt^2 phi_2(dt J) F_t term is well above the tolerance of the comparison
+    assert jnp.linalg.norm(ode_sys.fjac(t0, y0)._fdt()) > 0.1
+    assert jnp.allclose(s.y, exprb2_pfd_ref(ode_sys, t0, y0, dt, pfd_method))
+
+
+def test_exprb_pfd_banded(monkeypatch):
+    """
+    Check the banded PFD solves in the ExpRB integrators against dense PFD solves
+    """
+    # count the calls of the banded PFD solver
+    n_banded = [0]
+    f_phi_k_pfd_banded = ode_exp.f_phi_k_pfd_banded
+    def f_phi_k_pfd_banded_counted(*args, **kwargs):
+        n_banded[0] += 1
+        return f_phi_k_pfd_banded(*args, **kwargs)
+    monkeypatch.setattr(ode_exp, "f_phi_k_pfd_banded", f_phi_k_pfd_banded_counted)
+
+    dt = 0.1
+    pfd_method = "cram_16"
+    t0 = 1.54
+    # the P2 dofs are not banded in the natural ordering and need to be reordered
+    sem = AdDiffSEM(line_mesh(5), p=2, params={"nu": 1e-3, "vel": 0.5})
+    y0 = gauss_ic(sem)
+    N = y0.shape[0]
+    assert N >= 40
+
+    for sys_cls in [AffineLinearSEM, NonautonomousSEM]:
+        ode_sys = sys_cls(sem)
+        J = ode_sys.fjac(t0, y0).dense()
+        l, u = dense_bandwidth(J)
+        assert (l + u + 1) * 8 > N
+
+        # exprb2_pfd
+        sys_int = ExpRBIntegrator(ode_sys, t0, y0, method="exprb2_pfd", pfd_method=pfd_method)
+        t, y = t0, y0
+        for i in range(2):
+            n_calls = n_banded[0]
+            s = sys_int.step(dt)
+            sys_int.accept_step(s)
+            assert n_banded[0] > n_calls
+            y = exprb2_pfd_ref(ode_sys, t, y, dt, pfd_method)
+            t += dt
+            assert jnp.allclose(s.y, y)
+        # the ordering is only cached for time invariant systems
+        assert (sys_int._cached_jac_ordering is not None) == ode_sys.is_time_invariant
+
+        # exp_pfd
+        sys_int = ExpRBIntegrator(ode_sys, t0, y0, method="exp_pfd", pfd_method=pfd_method)
+        y = y0
+        for i in range(2):
+            n_calls = n_banded[0]
+            s = sys_int.step(dt)
+            sys_int.accept_step(s)
+            assert n_banded[0] > n_calls
+            y = f_phi_k_pfd(dt*J, y, 0, pfd_method)
+            assert jnp.allclose(s.y, y)
+        assert (sys_int._cached_jac_ordering is not None) == ode_sys.is_time_invariant
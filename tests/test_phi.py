@@ -8,7 +8,8 @@ import jax.numpy as jnp
 
 from ormatex_py.ode_sys import MatrixLinOp
 from ormatex_py.matexp_krylov import phi_linop, kiops_fixedsteps
-from ormatex_py.matexp_phi import f_phi_k, f_phi_k_ext, f_phi_k_appl, f_phi_k_sq, f_phi_k_pfd
+from ormatex_py.matexp_phi import f_phi_k, f_phi_k_ext, f_phi_k_appl, f_phi_k_sq, f_phi_k_pfd, \
+        f_phi_k_pfd_banded, banded_ordering
 
 jax.config.update("jax_enable_x64", True)
 
@@ -24,6 +25,19 @@ ref_phi = np.array([
     [ 0.10808308959542341,  0.1266237199582164,   0.15124928069313592,
       0.18476090064484876,  0.23154914510216867,  0.29863201236633136 ]])
 
+## common size of the random test matrices
+## each new shape triggers a recompile of the jitted phi functions, so the
+## random matrices A are embedded in Z = diag(A, -I) of a fixed size.
+## Since phi_k(Z) = diag(phi_k(A), phi_k(-1) I), the leading block is phi_k(A).
+pad_dim = 15
+
+
+def pad_blockdiag(a: np.ndarray, dim: int=pad_dim) -> jax.Array:
+    n = a.shape[0]
+    z = -np.eye(dim)
+    z[:n,:n] = a
+    return jnp.asarray(z, dtype=jnp.float64)
+
 
 def test_phi_0():
     """
@@ -42,14 +56,14 @@ def test_phi_0():
     for it in range(3):
         dim = 5*(it+1)
         np_test_a = np.random.randn(dim, dim)
-        test_a = jnp.asarray(np_test_a, dtype=jnp.float64)
+        test_a = pad_blockdiag(np_test_a)
         # test against scipy expm
         np_phi_0 = jnp.asarray(sp.linalg.expm(np_test_a))
-        jax_phi_0 = f_phi_k(test_a, k=0)
+        jax_phi_0 = f_phi_k(test_a, k=0)[:dim,:dim]
         assert jnp.allclose(np_phi_0, jax_phi_0)
-        jax_phi_0_ext = f_phi_k_ext(test_a, k=0)
+        jax_phi_0_ext = f_phi_k_ext(test_a, k=0)[:dim,:dim]
         assert jnp.allclose(np_phi_0, jax_phi_0_ext)
-        jax_phi_0_sq = f_phi_k_sq(test_a, k=0)
+        jax_phi_0_sq = f_phi_k_sq(test_a, k=0)[:dim,:dim]
         assert jnp.allclose(np_phi_0, jax_phi_0_sq)
 
 
@@ -68,13 +82,13 @@ def run_test_phi_k(k):
     for it in range(3):
         dim = 5*(it+1)
         np_test_a = np.random.randn(dim, dim)
-        test_a = jnp.asarray(np_test_a, dtype=jnp.float64)
+        test_a = pad_blockdiag(np_test_a)
 
         # test against different impl.
-        jax_phi_k = f_phi_k(test_a, k=k)
-        jax_phi_k_ext = f_phi_k_ext(test_a, k=k)
+        jax_phi_k = f_phi_k(test_a, k=k)[:dim,:dim]
+        jax_phi_k_ext = f_phi_k_ext(test_a, k=k)[:dim,:dim]
         assert jnp.allclose(jax_phi_k, jax_phi_k_ext)
-        jax_phi_k_sq = f_phi_k_sq(test_a, k=k)
+        jax_phi_k_sq = f_phi_k_sq(test_a, k=k)[:dim,:dim]
         assert jnp.allclose(jax_phi_k_sq, jax_phi_k_ext)
 
 
@@ -123,8 +137,9 @@ def test_phi_k_appl():
             dim = 5*(it+1)
             np_test_a = np.random.randn(dim, dim)
             np_test_b = np.random.randn(dim, 1)
-            test_a = jnp.asarray(np_test_a, dtype=jnp.float64)
-            test_b = jnp.asarray(np_test_b, dtype=jnp.float64)
+            test_a = pad_blockdiag(np_test_a)
+            # zero padding keeps phi_k(Z)B in the leading block
+            test_b = jnp.zeros((pad_dim, 1)).at[:dim].set(np_test_b)
 
             # test against different impl.
             jax_phi_k = f_phi_k(test_a, k=k)
@@ -158,6 +173,29 @@ def test_phi_k_appl_pfd():
 
     assert all(close.values())
 
+
+def test_phi_k_appl_pfd_banded():
+    """
+    Test banded solves in the partial fraction decomposition calc of phi_k(A)b products
+    """
+    # periodic pentadiagonal matrix with scrambled unknowns
+    np.random.seed(42)
+    dim = 40
+    np_test_a = -4.*np.eye(dim)
+    for d in (-2, -1, 1, 2):
+        np_test_a += np.diag(np.random.randn(dim-abs(d)), d)
+    np_test_a[0,-1] = np_test_a[-1,0] = 1.
+    q = np.random.permutation(dim)
+    np_test_a = np_test_a[np.ix_(q, q)]
+    np_test_b = np.random.randn(dim, 2)
+
+    perm, lu = banded_ordering(np_test_a)
+    assert lu[0] + lu[1] + 1 <= 9
+    for k in range(ref_phi.shape[0]):
+        phi_k_b = f_phi_k_pfd(jnp.asarray(np_test_a), jnp.asarray(np_test_b), k=k, method="cram_16")
+        phi_k_b_banded = f_phi_k_pfd_banded(np_test_a, np_test_b, k=k, method="cram_16", perm=perm, lu=lu)
+        assert jnp.allclose(phi_k_b, phi_k_b_banded)
+
 def test_phi_linop_0():
     """
     Computes phi_0(A*dt)*b
@@ -248,8 +286,8 @@ def test_phi_badmat_1():
                     [ 0.00000000e+00, 0.00000000e+00, 0.00000000e+00, 0.00000000e+00, 0.00000000e+00 , 0.00000000e+00, 0.00000000e+00]])
 
     # expect our phi scaling and squaring impl to pass
-    phi_0 = f_phi_k_sq(z, 0)
-    phi_1 = f_phi_k_sq(z, 1)
+    # phi_0 and phi_1 from a single scaling and squaring pass
+    phi_0, phi_1 = f_phi_k_sq(z, 1, return_all=True)
     assert not jnp.isnan(jnp.sum(phi_0))
     assert not jnp.isnan(jnp.sum(phi_1))
     # check phi_1 = z^-1 (phi_0 - I)